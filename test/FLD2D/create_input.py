@@ -1,59 +1,137 @@
 #!/usr/bin/env python3
 
+import os
+import functools
 import numpy as np
 import yaml
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
 import astropy.constants as const
 import astropy.units as units
-from types import SimpleNamespace
 
 basedir = "../../output/tests/FLD2D"
 
+# settings which are used as floating point numbers
+float_settings = ["t0", "tfinal", "offset", "f0", "x0", "K"]
+
+@functools.lru_cache(maxsize=None)
+def _load_yaml(filename, mtime):
+    with open(filename, "r") as infile:
+        return yaml.load(infile, Loader=SafeLoader)
+
+def load_yaml(filename):
+    """Parse a yaml file, reusing the result as long as the file is unchanged."""
+    filename = os.path.abspath(filename)
+    return dict(_load_yaml(filename, os.path.getmtime(filename)))
+
+class FargoGrid:
+    """Polar grid of the simulation.
+
+    Only the 1D coordinate vectors are stored. The 2D coordinate arrays
+    (Ri, Phii, Xi, Yi, Rc, Phic, Xc, Yc) are built by broadcasting on first
+    access and can be freed again with e.g. `del g.Xc`.
+    """
+
+    def __init__(self, Nrad, Naz, ri, phii):
+        self.Nrad = Nrad
+        self.Naz = Naz
+
+        self.ri = ri
+        self.phii = phii
+        # cos and sin from a single complex exponential
+        ei = np.exp(1j*phii)
+        self.cos_phii = ei.real.copy()
+        self.sin_phii = ei.imag.copy()
+
+        self.rc = 2/3*(ri[1:]**2/(ri[1:]+ri[:-1]) + ri[:-1]) # approx center in polar coords
+        self.phic = 0.5*(phii[1:]+phii[:-1])
+        ec = np.exp(1j*self.phic)
+        self.cos_phic = ec.real.copy()
+        self.sin_phic = ec.imag.copy()
+
+        self.dphi = phii[1] - phii[0]
+        self.dr = ri[1:] - ri[:-1]
+        # cell areas only depend on the radius
+        self.A = np.broadcast_to((0.5*(ri[1:]**2 - ri[:-1]**2)*self.dphi)[:,None], (Nrad, Naz))
+
+    @functools.cached_property
+    def Ri(self):
+        return np.broadcast_to(self.ri[:,None], (self.Nrad+1, self.Naz+1))
+
+    @functools.cached_property
+    def Phii(self):
+        return np.broadcast_to(self.phii[None,:], (self.Nrad+1, self.Naz+1))
+
+    @functools.cached_property
+    def Xi(self):
+        return self.ri[:,None]*self.cos_phii[None,:]
+
+    @functools.cached_property
+    def Yi(self):
+        return self.ri[:,None]*self.sin_phii[None,:]
+
+    @functools.cached_property
+    def Rc(self):
+        return np.broadcast_to(self.rc[:,None], (self.Nrad, self.Naz))
+
+    @functools.cached_property
+    def Phic(self):
+        return np.broadcast_to(self.phic[None,:], (self.Nrad, self.Naz))
+
+    @functools.cached_property
+    def Xc(self):
+        return self.rc[:,None]*self.cos_phic[None,:]
+
+    @functools.cached_property
+    def Yc(self):
+        return self.rc[:,None]*self.sin_phic[None,:]
+
+
 def get_fargo_grid(setupfile):
 
     # get size of grid specified in the setup file
-    with open(setupfile, "r") as infile:
-        params = yaml.safe_load(infile)
-        Nrad = params["Nrad"]
-        Naz = params["Naz"]
+    params = load_yaml(setupfile)
+    Nrad = params["Nrad"]
+    Naz = params["Naz"]
 
     ri = np.genfromtxt(f"{basedir}/out/used_rad.dat")
     phii = np.linspace(0, 2*np.pi, Naz+1)
-    Ri, Phii = np.meshgrid(ri, phii, indexing="ij")
-    Xi = Ri*np.cos(Phii)
-    Yi = Ri*np.sin(Phii)
-
-    rc = 2/3*(ri[1:]**2/(ri[1:]+ri[:-1]) + ri[:-1]) # approx center in polar coords
-    phic = 0.5*(phii[1:]+phii[:-1])
-    Rc, Phic = np.meshgrid(rc, phic, indexing="ij")
-    Xc = Rc*np.cos(Phic)
-    Yc = Rc*np.sin(Phic)
-
-    dphi = phii[1] - phii[0]
-    dr = ri[1:] - ri[:-1]
-    A = 0.5*(Ri[1:,1:]**2 - Ri[:-1,1:]**2)*dphi
-
-    return SimpleNamespace(
-        Nrad=Nrad, Naz=Naz,
-        ri=ri, phii=phii, Ri=Ri, Phii=Phii, Xi=Xi, Yi=Yi,
-        rc=rc, phic=phic, Rc=Rc, Phic=Phic, Xc=Xc, Yc=Yc, 
-        dphi=dphi, dr=dr, A=A
-    )
 
-def analytical_solution(r, t, x0, K, offset=0.0):
-    return x0/(4*np.pi*t*K)*np.exp(-(r**2)/(4*K*t)) + offset
+    return FargoGrid(Nrad, Naz, ri, phii)
+
+def _gaussian_from_r2(r2, t, x0, K, offset=0.0):
+    # evaluate x0/(4 pi t K) exp(-r2/(4Kt)) + offset in place, overwriting r2
+    np.multiply(r2, -1.0/(4*K*t), out=r2)
+    np.exp(r2, out=r2)
+    np.multiply(r2, x0/(4*np.pi*t*K), out=r2)
+    np.add(r2, offset, out=r2)
+    return r2
 
-def get_setup_params():
-    with open("test_settings.yml", "r") as infile:
-        params = yaml.safe_load(infile)
+def analytical_solution(r, t, x0, K, offset=0.0):
+    r = np.asarray(r, dtype=np.float64)
+    return _gaussian_from_r2(np.multiply(r, r, out=np.empty_like(r)), t, x0, K, offset=offset)
+
+@functools.lru_cache(maxsize=None)
+def _get_setup_params(filename, mtime):
+    params = dict(_load_yaml(filename, mtime))
+    for key in float_settings:
+        if key in params:
+            params[key] = float(params[key])
     return params
 
+def get_setup_params(filename="test_settings.yml"):
+    filename = os.path.abspath(filename)
+    return dict(_get_setup_params(filename, os.path.getmtime(filename)))
+
 def get_solution_array(setupfile, t):
     g = get_fargo_grid(setupfile)
     params = get_setup_params()
 
-    f0 = float(params["f0"])
+    f0 = params["f0"]
     finit = f0 #/ g.A[nr, nphi]
-    offset = float(params["offset"])*finit
+    offset = params["offset"]*finit
 
 
     # determine location of cell closest to x0
@@ -67,14 +145,16 @@ def get_solution_array(setupfile, t):
     K = params["K"]
     # print(f"Analytical solution at t = {t:e}, K = {K}, y0 = {finit}, offset = {offset}")
     
-    xcell = g.Xc[nr, nphi]
-    ycell = g.Yc[nr, nphi]
-
-    DX = g.Xc - xcell
-    DY = g.Yc - ycell
-    Dist = np.sqrt(DX**2 + DY**2)
+    # distance to the cell center by the law of cosines,
+    # this only needs broadcasts of the 1D coordinate vectors
+    r0 = g.rc[nr]
+    rc = g.rc[:,None]
+    cos_dphi = np.cos(g.phic - g.phic[nphi])[None,:]
+    Dist2 = np.multiply(-2*r0*rc, cos_dphi)
+    np.add(Dist2, rc**2 + r0**2, out=Dist2)
 
-    return analytical_solution(Dist, t, finit, K, offset=offset)
+    # the solution only depends on the squared distance
+    return _gaussian_from_r2(Dist2, t, finit, K, offset=offset)
 
 
 
@@ -82,15 +162,14 @@ if __name__ == "__main__":
     # now create an energy array with values in cgs with the energy located in one cell
     
     # get initial time
-    with open("test_settings.yml", "r") as infile:
-        params = yaml.safe_load(infile)
-        t0 = float(params["t0"])
+    t0 = get_setup_params()["t0"]
 
     f0 = get_solution_array("setup.yml", t0)
 
     print("f grid size", f0.shape)
     print("f max", np.max(f0))
 
-    np.array(f0, dtype=np.float64).tofile(f"{basedir}/out/f_FLD2Dtest_input.dat")
+    # no copy if the array is already contiguous float64
+    np.ascontiguousarray(f0, dtype=np.float64).tofile(f"{basedir}/out/f_FLD2Dtest_input.dat")
 
     
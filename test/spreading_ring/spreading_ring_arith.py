@@ -83,9 +83,10 @@ def test_2D(out, ax, dt):
     nphi = int(N/nr)
 
     phi_range = np.linspace(0, 2*np.pi, nphi+1)
-    phi, r = np.meshgrid(phi_range, Radii)
-    X = r*np.cos(phi)
-    Y = r*np.sin(phi)
+    cos_phi = np.cos(phi_range)
+    sin_phi = np.sin(phi_range)
+    X = Radii[:, None]*cos_phi[None, :]
+    Y = Radii[:, None]*sin_phi[None, :]
 
     cmap = mpl.cm.get_cmap("CMRmap").copy()
 
@@ -114,9 +115,8 @@ def test_3D(out, ax, dt):
     data = data.reshape((nr, nphi))
 
     phi_range = np.linspace(0, 2*np.pi, nphi+1)
-    phi, r = np.meshgrid(phi_range, Radii)                                                                         
-    X = phi
-    Y = r
+    X = phi_range
+    Y = Radii
 
     cmap = mpl.cm.get_cmap("CMRmap").copy()
 